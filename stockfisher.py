@@ -1,12 +1,18 @@
 #! /usr/bin/env -S python3 -u
 
 import os
+import sys
 import argparse
 import shutil
-import subprocess
+import signal
+import selectors
 import random
+import re
 import time
 import contextlib
+import queue
+import threading
+import concurrent.futures
 from enum import Enum
 from typing import Optional
 
@@ -15,50 +21,160 @@ try:
 except ModuleNotFoundError:
     colorama = None
 
+_EMPTY = ord(' ') # The byte value of an empty square in Board.board.
+
+_EMPTY_BOARD = b' ' * 64
+
+_PRINT_TABLE = bytes.maketrans(b' ', b'.') # Translates Board.board for printing.
+
+_EMPTY_RUNS = tuple(('1' * n, str(n)) for n in range(8, 1, -1)) # Runs of empty squares, and their FEN digits.
+
+_SCORE_RE = re.compile(rb'\bscore (cp|mate) (-?\d+)') # The score in an 'info' line.
+
+def _make_step_table(steps: list[tuple[int, int]]) -> list[tuple[int, ...]]:
+    """For each square, make a tuple of squares that can be reached by a single step."""
+    table = []
+    for pos in range(64):
+        (y, x) = divmod(pos, 8)
+        table.append(tuple((y + dy) * 8 + (x + dx) for (dx, dy) in steps if 0 <= x + dx < 8 and 0 <= y + dy < 8))
+    return table
+
+
+def _make_ray_table(directions: list[tuple[int, int]]) -> list[tuple[tuple[int, ...], ...]]:
+    """For each square, make a tuple of rays; each ray is a tuple of squares, ordered by distance."""
+    table = []
+    for pos in range(64):
+        (y, x) = divmod(pos, 8)
+        rays = []
+        for (dx, dy) in directions:
+            ray = []
+            (rx, ry) = (x + dx, y + dy)
+            while 0 <= rx < 8 and 0 <= ry < 8:
+                ray.append(ry * 8 + rx)
+                (rx, ry) = (rx + dx, ry + dy)
+            if len(ray) != 0:
+                rays.append(tuple(ray))
+        table.append(tuple(rays))
+    return table
+
+
+# Attack tables, indexed by the square of the attacked king. Square 0 is a8; square 63 is h1.
+_KNIGHT_ATTACKS = _make_step_table([(1, 2), (2, 1), (2, -1), (1, -2), (-1, -2), (-2, -1), (-2, 1), (-1, 2)])
+_KING_ATTACKS   = _make_step_table([(1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1)])
+_WHITE_PAWN_ATTACKS = _make_step_table([(-1, -1), (1, -1)]) # Squares from where a black pawn attacks a white king.
+_BLACK_PAWN_ATTACKS = _make_step_table([(-1, 1), (1, 1)])   # Squares from where a white pawn attacks a black king.
+_ORTHOGONAL_RAYS = _make_ray_table([(1, 0), (0, 1), (-1, 0), (0, -1)])
+_DIAGONAL_RAYS   = _make_ray_table([(1, 1), (-1, 1), (-1, -1), (1, -1)])
+
+
 class Board:
-    """Represents a chess board."""
+    """Represents a chess board.
+
+    The board is stored as a bytearray of 64 ASCII piece letters, with b' ' for an empty square.
+    """
+
+    __slots__ = ("board", )
 
     def __init__(self):
         """Initialize as empty board."""
-        self.board = [' ' for i in range(64)]
+        self.board = bytearray(_EMPTY_BOARD)
 
     def mk_empty(self) -> None:
-        """Remove all pieces from the board."""
-        self.board = [' ' for i in range(64)]
+        """Remove all pieces from the board.
+
+        The bytearray is overwritten in place, so a Board reused for many positions doesn't allocate a new one each time.
+        """
+        self.board[:] = _EMPTY_BOARD
 
     def mk_initial(self) -> None:
         """Set up initial pieces."""
-        self.board = ['r', 'n', 'b', 'q', 'k', 'b', 'n', 'r',
-                      'p', 'p', 'p', 'p', 'p', 'p', 'p', 'p',
-                      ' ', ' ', ' ', ' ', ' ', ' ', ' ', ' ',
-                      ' ', ' ', ' ', ' ', ' ', ' ', ' ', ' ',
-                      ' ', ' ', ' ', ' ', ' ', ' ', ' ', ' ',
-                      ' ', ' ', ' ', ' ', ' ', ' ', ' ', ' ',
-                      'P', 'P', 'P', 'P', 'P', 'P', 'P', 'P',
-                      'R', 'N', 'B', 'Q', 'K', 'B', 'N', 'R']
+        self.board = bytearray(b'rnbqkbnr'
+                               b'pppppppp'
+                               b'        '
+                               b'        '
+                               b'        '
+                               b'        '
+                               b'PPPPPPPP'
+                               b'RNBQKBNR')
 
     def place_random_pieces(self, pieces: str) -> None:
-        """Place a bunch of pieces randomly on the board."""
-        empty_positions = set(i for i in range(64) if self.board[i] == ' ')
-        valid_pawn_positions = set(range(8, 56))
-        for piece in pieces:            
-            if piece in ('p', 'P'):
-                candidate_positions = (empty_positions & valid_pawn_positions)
-            else:
-                candidate_positions = empty_positions
+        """Place a bunch of pieces randomly on the board.
+
+        Pawns are placed first, on empty squares outside the first and last rank.
+        The other pieces are then placed on the remaining empty squares.
+
+        Raises IllegalPositionError if this puts the two kings next to each other.
+        """
+        pawns = [ord(piece) for piece in pieces if piece in ('p', 'P')]
+        others = [ord(piece) for piece in pieces if piece not in ('p', 'P')]
+
+        # The board itself keeps track of the occupied squares; the pawns are on it before we look for the other squares.
+        board = self.board
+
+        pawn_positions = random.sample([i for i in range(8, 56) if board[i] == _EMPTY], len(pawns))
+        for (pos, piece) in zip(pawn_positions, pawns):
+            board[pos] = piece
+
+        other_positions = random.sample([i for i in range(64) if board[i] == _EMPTY], len(others))
+        for (pos, piece) in zip(other_positions, others):
+            board[pos] = piece
+
+        white_king = board.find(b'K')
+        black_king = board.find(b'k')
+        if white_king >= 0 and black_king >= 0:
+            ((wy, wx), (by, bx)) = (divmod(white_king, 8), divmod(black_king, 8))
+            if abs(wx - bx) <= 1 and abs(wy - by) <= 1:
+                raise IllegalPositionError("The kings are on adjacent squares.")
+
+    def is_king_attacked(self, color: str) -> bool:
+        """Check if the king of the given color ("w" or "b") is attacked by an enemy piece.
+
+        If the board has no king of the given color, it is not attacked.
+        """
+        if color == "w":
+            king_pos = self.board.find(b'K')
+            (knight, king, pawn, rook, bishop, queen) = b'nkprbq'
+            pawn_attacks = _WHITE_PAWN_ATTACKS
+        elif color == "b":
+            king_pos = self.board.find(b'k')
+            (knight, king, pawn, rook, bishop, queen) = b'NKPRBQ'
+            pawn_attacks = _BLACK_PAWN_ATTACKS
+        else:
+            raise ValueError()
+
+        if king_pos < 0:
+            return False
+
+        board = self.board
+
+        for pos in _KNIGHT_ATTACKS[king_pos]:
+            if board[pos] == knight:
+                return True
+
+        for pos in _KING_ATTACKS[king_pos]:
+            if board[pos] == king:
+                return True
+
+        for pos in pawn_attacks[king_pos]:
+            if board[pos] == pawn:
+                return True
 
-            pos = random.choice(list(candidate_positions))
-            self.board[pos] = piece
-            empty_positions.remove(pos)
+        for (rays, slider) in ((_ORTHOGONAL_RAYS, rook), (_DIAGONAL_RAYS, bishop)):
+            for ray in rays[king_pos]:
+                for pos in ray:
+                    f = board[pos]
+                    if f != _EMPTY:
+                        if f == slider or f == queen:
+                            return True
+                        break
+
+        return False
 
     def print_board(self) -> None:
-        for y in range(8):
-            for x in range(8):
-                f = self.board[y * 8 + x]
-                if f == ' ':
-                    f = '.'
-                print(f, end='')
-            print()
+        """Print the board, one rank per line, with '.' for an empty square."""
+        squares = self.board.translate(_PRINT_TABLE).decode('ascii')
+        for i in range(0, 64, 8):
+            print(squares[i:i + 8])
 
     def fen(self, mover: str) -> str:
         """Represent the board as a FEN string.
@@ -68,24 +184,23 @@ class Board:
         if mover not in ("w", "b"):
             raise ValueError()
 
+        # Write each empty square as '1', then collapse runs of '1's into their length, longest runs first.
+        squares = self.board.decode('ascii').replace(' ', '1')
         ranks = []
-        for y in range(8):
-            rank = []
-            for x in range(8):
-                f = self.board[y * 8 + x]
-                if f == ' ':
-                    if len(rank) != 0 and rank[-1] in "1234567":
-                        pawn_count = int(rank.pop()) + 1
-                    else:
-                        pawn_count = 1
-                    rank.append(str(pawn_count))
-                else:
-                    rank.append(f)
-            ranks.append("".join(rank))
+        for i in range(0, 64, 8):
+            rank = squares[i:i + 8]
+            for (run, length) in _EMPTY_RUNS:
+                rank = rank.replace(run, length)
+            ranks.append(rank)
         fen_board = "/".join(ranks)
         return "{} {} - - 0 1".format(fen_board, mover)
 
 
+class IllegalPositionError(Exception):
+    """Represents a randomly generated position that cannot occur in a game."""
+    pass
+
+
 class StockfishException(Exception):
     """Represents an exception while talking to Stockfish."""
     pass
@@ -102,10 +217,36 @@ class StockfishStatus(Enum):
 
 
 class Stockfish:
+    """Talks to a Stockfish sub-process using the UCI protocol.
 
-    def __init__(self, executable: str):
+    All methods besides open(), close() and wait() require the sub-process to be running;
+    this is not checked, so use the Stockfish instance as a context manager.
+    """
+
+    def __init__(self, executable: str, options: Optional[dict[str, str]]=None, verify_readback: Optional[int]=100, timeout: Optional[float]=None, cpu: Optional[int]=None):
+        """Initialize the Stockfish interface.
+
+        The 'options' are UCI options that are set whenever a sub-process is started.
+        The FEN strings passed to the first 'verify_readback' set_fen() calls are compared
+        to the FEN strings reported by Stockfish; if None, this is done for all calls.
+        A sub-process that produces no output for 'timeout' seconds while we are waiting
+        for it is considered hung, and is killed; set_fen() and evaluate_batch() then start a
+        new one. If 'timeout' is None, we wait indefinitely.
+        If 'cpu' is given, each sub-process is pinned to that logical CPU.
+        """
         self.executable = executable
-        self.stockfish = None
+        self.options = options if options is not None else {}
+        self.verify_readback = verify_readback
+        self.timeout = timeout
+        self.cpu = cpu
+        self.pid = None
+        self.stdin_fd = None
+        self.stdout_fd = None
+        self.selector = None
+        self.returncode = None
+        self.batch = bytearray()
+        self.rbuf = bytearray()
+        self.rpos = 0 # Start of the unread part of 'rbuf'.
 
     def __enter__(self):
         self.open()
@@ -115,115 +256,195 @@ class Stockfish:
         self.close()
 
     def _send_command(self, command: str) -> None:
-        """Send a command to the Stockfish sub-process."""
-        if self.stockfish is None:
-            raise RuntimeError()
-        self.stockfish.stdin.write((command + "\n").encode('ascii'))
-        self.stockfish.stdin.flush()
+        """Append a command to the batch of commands to be sent to the Stockfish sub-process."""
+        self.batch += (command + "\n").encode('ascii')
+
+    def _flush_batch(self) -> None:
+        """Send the batch of pending commands to the Stockfish sub-process in a single write."""
+        batch = memoryview(bytes(self.batch))
+        self.batch.clear()
+        while len(batch) != 0:
+            batch = batch[os.write(self.stdin_fd, batch):]
+
+    def _fill_buffer(self) -> None:
+        """Wait for output from the Stockfish sub-process, and append it to the read buffer.
+
+        Lines that have already been read are dropped from the buffer first.
+        """
+        del self.rbuf[:self.rpos]
+        self.rpos = 0
+        if not self.selector.select(self.timeout):
+            # The sub-process is hung. Kill it, so that wait() can reap it after this exception is handled.
+            os.kill(self.pid, signal.SIGKILL)
+            raise StockfishException("StockFish did not respond in {} seconds".format(self.timeout))
+        data = os.read(self.stdout_fd, 65536)
+        if len(data) == 0:
+            # End-of-file; the sub-process has gone away.
+            raise StockfishException("StockFish quit (exitcode: {})".format(self._reap()))
+        self.rbuf += data
+
+    def _readline_bytes(self) -> bytes:
+        """Read a line from the Stockfish sub-process, including its terminating newline.
+
+        We only look for the newline in the part of the buffer that hasn't been scanned yet.
+        """
+        scanned = 0
+        while True:
+            nl = self.rbuf.find(b"\n", self.rpos + scanned)
+            if nl >= 0:
+                break
+            scanned = len(self.rbuf) - self.rpos
+            self._fill_buffer()
+        line = bytes(self.rbuf[self.rpos:nl + 1])
+        self.rpos = nl + 1
+        return line
 
     def _readline(self) -> str:
         """Read a line from the Stockfish sub-process."""
-        return self.stockfish.stdout.readline().decode('ascii').strip()
+        return self._readline_bytes().decode('ascii').strip()
+
+    def _read_until_tokens(self, tokens: set[bytes]) -> bytes:
+        """Read lines from the Stockfish sub-process until each of the tokens has been seen at the start of a line.
+
+        The lines are returned undecoded, as a single buffer.
+        """
+        pending = set(tokens)
+        buffer = bytearray()
+        while len(pending) != 0:
+            line = self._readline_bytes()
+            buffer += line
+            pending = set(token for token in pending if not line.startswith(token))
+        return bytes(buffer)
+
+    def _reap(self) -> int:
+        """Wait for the Stockfish sub-process to terminate, and return its exit code."""
+        if self.returncode is None:
+            (pid, status) = os.waitpid(self.pid, 0)
+            self.returncode = os.waitstatus_to_exitcode(status)
+        return self.returncode
 
     def open(self) -> None:
-        """Start a Stockfish sub-process and put it in "uci" mode."""
-        if self.stockfish is not None:
+        """Start a Stockfish sub-process, put it in "uci" mode, and apply our UCI options."""
+        if self.pid is not None:
             raise RuntimeError()
-        self.stockfish = subprocess.Popen([self.executable], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+        # The pipe ends become the child's stdin and stdout. The original descriptors are
+        # not inheritable, so they are closed in the child when it executes Stockfish.
+        (stdin_read, stdin_write) = os.pipe()
+        (stdout_read, stdout_write) = os.pipe()
+        try:
+            file_actions = [(os.POSIX_SPAWN_DUP2, stdin_read, 0), (os.POSIX_SPAWN_DUP2, stdout_write, 1)]
+            # Python ignores SIGPIPE and SIGXFSZ; like subprocess.Popen, restore their default handling in the child.
+            self.pid = os.posix_spawn(self.executable, [self.executable], os.environ, file_actions=file_actions,
+                                      setsigdef=(signal.SIGPIPE, signal.SIGXFSZ))
+        except OSError:
+            os.close(stdin_write)
+            os.close(stdout_read)
+            raise
+        finally:
+            os.close(stdin_read)
+            os.close(stdout_write)
+
+        if self.cpu is not None:
+            os.sched_setaffinity(self.pid, {self.cpu})
+
+        self.stdin_fd = stdin_write
+        self.stdout_fd = stdout_read
+        os.set_blocking(self.stdout_fd, False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.stdout_fd, selectors.EVENT_READ)
+        self.returncode = None
+
         self._send_command("uci")
+        self._flush_batch()
         while True:
             line = self._readline()
             if line == "uciok":
                 break
+        for (name, value) in self.options.items():
+            self._send_command("setoption name {} value {}".format(name, value))
+
+        # A single 'ucinewgame' per sub-process suffices. Our positions are unrelated to each other; a search
+        # in one of them does not depend on hash table entries left behind by the others, so we don't pay for
+        # clearing the table before each position.
+        self._send_command("ucinewgame")
 
     def close(self) -> None:
         """Tell the Stockfish sub-process to quit, and wait for it to do so."""
-        if self.stockfish is None:
+        if self.pid is None:
             raise RuntimeError()
         self._send_command("quit")
-        self.stockfish.wait()
+        with contextlib.suppress(BrokenPipeError):
+            self._flush_batch()
+        self.wait()
 
     def wait(self) -> None:
         """Wait for the Stockfish sub-process to terminate."""
-        if self.stockfish is None:
+        if self.pid is None:
             raise RuntimeError()
-        self.stockfish.wait()
-        self.stockfish = None
+        self._reap()
+        # Commands that could not be delivered, and output that was not read, are discarded.
+        self.batch.clear()
+        self.rbuf.clear()
+        self.rpos = 0
+        self.selector.close()
+        os.close(self.stdin_fd)
+        os.close(self.stdout_fd)
+        self.pid = None
+        self.stdin_fd = None
+        self.stdout_fd = None
+        self.selector = None
     
     def newgame(self) -> None:
         """Send a 'new game' command to Stockfish."""
-        if self.stockfish is None:
-            raise RuntimeError()
         self._send_command("ucinewgame")
+        self._flush_batch()
 
     def ping(self) -> None:
         """Interact with Stockfish and see if we get the expected response."""
-        if self.stockfish is None:
-            raise RuntimeError()
         self._send_command("isready")
-        while True:
-            returncode = self.stockfish.poll()
-            if returncode is not None:
-                raise StockfishException("StockFish quit (exitcode: {})".format(returncode))
-
-            line = self._readline()
-            if line == "readyok":
-                return
+        self._flush_batch()
+        self._read_until_tokens({b"readyok"})
 
     def set_fen(self, fen: str) -> StockfishStatus:
-        """Set a FEN position in the Stockfish sub-process and check its status."""
-        self.newgame()
-        command = "position fen {}".format(fen)
-        self._send_command(command)
+        """Set a FEN position in the Stockfish sub-process and check its status.
+
+        The position, ping, and display commands are sent as a single batch,
+        and the responses are read in a single pass.
+        """
+        self._send_command("position fen {}".format(fen))
+        self._send_command("isready")
+        self._send_command("d")
 
         try:
-            self.ping()
-        except StockfishException:
+            self._flush_batch()
+            dump = self._read_until_tokens({b"readyok", b"Checkers:"})
+        except (StockfishException, BrokenPipeError):
             # Stockfish crashed.
             # Clean up the sub-process, start a new one, and report failure.
             self.wait()
             self.open()
             return StockfishStatus.Fault
 
-        (readback_fen, in_check) = self._get_fen_and_check_status()
-        if fen != readback_fen:
-            raise RuntimeError("FEN was not correctly set: {}".format(fen))
+        # Once Stockfish has confirmed enough of our FEN strings, stop checking them.
+        # The check is done on the raw output of the 'd' command, for its "Fen: " line.
+        if self.verify_readback is None or self.verify_readback > 0:
+            if (b"Fen: " + fen.encode('ascii') + b"\n") not in dump:
+                raise RuntimeError("FEN was not correctly set: {}".format(fen))
+            if self.verify_readback is not None:
+                self.verify_readback -= 1
+
+        # Stockfish lists the squares of the checking pieces on its "Checkers:" line, which is otherwise empty.
+        in_check = not (b"\nCheckers: \n" in dump or b"\nCheckers:\n" in dump)
 
         if in_check:
             return StockfishStatus.MoverInCheck
         else:
             return StockfishStatus.MoverNotInCheck
 
-    def _get_fen_and_check_status(self) -> tuple[str, bool]:
-        """Check the current status of Stockfish. Get the FEN board, and the in-check status."""
-        if self.stockfish is None:
-            raise RuntimeError()
-        fen = None
-        in_check = None
-        self._send_command("d")
-        while True:
-            line = self._readline()
-            if line.startswith("Fen: "):
-                if fen is not None:
-                    raise RuntimeError()
-                fen = line[5:]
-            elif line.startswith("Checkers:"):
-                if in_check is not None:
-                    raise RuntimeError()
-                in_check = (line != "Checkers:")
-                break
-        if fen is None:
-            raise RuntimeError()
-        if in_check is None:
-            raise RuntimeError()
-
-        return (fen, in_check)
-
-    def evaluate(self, *, depth: Optional[int]=None, movetime: Optional[int]=None):
-        """Get an evaluation from Stockfish of the current position."""
-        if self.stockfish is None:
-            raise RuntimeError()
-
+    @staticmethod
+    def _go_command(depth: Optional[int], movetime: Optional[int]) -> str:
+        """Make a 'go' command with the given search limits."""
         arguments = []
 
         if depth is not None:
@@ -232,26 +453,166 @@ class Stockfish:
         if movetime is not None:
             arguments.extend(["movetime", str(movetime)])
 
-        command = "go {}".format(" ".join(arguments))
+        return "go {}".format(" ".join(arguments))
+
+    @staticmethod
+    def _parse_evaluation(info: Optional[bytes]) -> str:
+        """Get the evaluation from the last 'info' line of a search."""
+        if info is None:
+            raise RuntimeError("No info lines found.")
+
+        match = _SCORE_RE.search(info)
+        if match is None:
+            raise RuntimeError("No score found in info line: {}".format(info.decode('ascii').strip()))
 
-        self._send_command(command)
+        evaluation = "{} {}".format(match.group(1).decode('ascii'), match.group(2).decode('ascii'))
+
+        return evaluation
+
+    def evaluate(self, *, depth: Optional[int]=None, movetime: Optional[int]=None):
+        """Get an evaluation from Stockfish of the current position.
+
+        If both a depth and a move time (ms) are given, the search ends at whichever limit is reached first.
+        """
+        self._send_command(self._go_command(depth, movetime))
+        self._flush_batch()
 
         info = None
         while True:
-            line = self._readline()
-            if line.startswith("info"):
+            line = self._readline_bytes()
+            if line.startswith(b"info"):
                 info = line
-            if line.startswith("bestmove"):
+            if line.startswith(b"bestmove"):
                 break
 
-        if info is None:
-            raise RuntimeError("No info lines found.")
+        return self._parse_evaluation(info)
 
-        info_split = info.split()
-        idx = info_split.index("score")
-        evaluation = " ".join(info_split[idx+1:idx+3])
+    def evaluate_batch(self, fens: list[str], *, depth: Optional[int]=None, movetime: Optional[int]=None) -> list[Optional[tuple[str, float]]]:
+        """Get evaluations from Stockfish of a number of positions, given as FEN strings.
 
-        return evaluation
+        Stockfish starts the clock of a search when it reads the 'go' command, so we keep a single
+        search in flight: the commands for the next position are sent as soon as the result of the
+        previous search has come in.
+
+        For each position, the evaluation and the duration of its search are returned.
+        If Stockfish crashes or hangs during a search, it is restarted, and None is returned for that position.
+        """
+        go_command = self._go_command(depth, movetime)
+
+        results = []
+        for fen in fens:
+            try:
+                self._send_command("position fen {}".format(fen))
+                self._send_command(go_command)
+                self._flush_batch()
+                t1 = time.monotonic()
+                info = None
+                while True:
+                    line = self._readline_bytes()
+                    if line.startswith(b"info"):
+                        info = line
+                    if line.startswith(b"bestmove"):
+                        break
+                t2 = time.monotonic()
+            except (StockfishException, BrokenPipeError):
+                # Stockfish crashed, or was killed because it hung.
+                # Clean up the sub-process, start a new one, and report failure.
+                self.wait()
+                self.open()
+                results.append(None)
+                continue
+
+            results.append((self._parse_evaluation(info), t2 - t1))
+
+        return results
+
+
+def physical_cpus() -> list[int]:
+    """Get the CPUs we may run on, keeping only the first hardware thread of each physical core."""
+    cpus = []
+    cores = set()
+    for cpu in sorted(os.sched_getaffinity(0)):
+        try:
+            with open("/sys/devices/system/cpu/cpu{}/topology/thread_siblings_list".format(cpu)) as fi:
+                core = fi.read().strip()
+        except FileNotFoundError:
+            core = str(cpu)
+        # All hardware threads of a core report the same list of siblings.
+        if core not in cores:
+            cores.add(core)
+            cpus.append(cpu)
+    return cpus
+
+
+def generate_candidates(candidates: queue.Queue, material: str) -> None:
+    """Generate random positions, and put their FEN strings (black to move, white to move) in the 'candidates' queue.
+
+    This runs forever, in a daemon thread, so that generation overlaps with Stockfish evaluations.
+    If generation fails, the exception is put in the queue instead, for the consumers to re-raise.
+    """
+    board = Board()
+    try:
+        while True:
+
+            board.mk_empty()
+            try:
+                board.place_random_pieces(material)
+            except IllegalPositionError:
+                continue
+
+            # We only accept positions where neither king is in check.
+            # Reject the obvious cases here, without a round-trip to Stockfish.
+            if board.is_king_attacked('w') or board.is_king_attacked('b'):
+                continue
+
+            candidates.put((board.fen('b'), board.fen('w')))
+    except Exception as exception:
+        candidates.put(exception)
+
+
+def find_positions(engines: queue.Queue, candidates: queue.Queue, count: int, movetime: float, min_depth: Optional[int]) -> list[tuple[str, float, str]]:
+    """Take candidate positions until 'count' of them pass the Stockfish checks and have been evaluated.
+
+    A Stockfish instance is taken from the 'engines' pool for the duration of the search,
+    and returned to the pool afterwards.
+    """
+    stockfish = engines.get()
+    try:
+        results = []
+        while len(results) != count:
+
+            fens = []
+            while len(fens) != count - len(results):
+
+                candidate = candidates.get()
+                if isinstance(candidate, Exception):
+                    # The generator has stopped. Leave its exception in the queue for the other workers.
+                    candidates.put(candidate)
+                    raise RuntimeError("Candidate position generation failed.") from candidate
+
+                (fen_black, fen_white) = candidate
+
+                status = stockfish.set_fen(fen_black)
+                if status in (StockfishStatus.MoverInCheck, StockfishStatus.Fault):
+                    continue
+
+                status = stockfish.set_fen(fen_white)
+                if status in (StockfishStatus.MoverInCheck, StockfishStatus.Fault):
+                    continue
+
+                fens.append(fen_white)
+
+            # Stockfish stops searching when either the depth or the time limit is reached.
+            evaluations = stockfish.evaluate_batch(fens, depth = min_depth, movetime = round(movetime * 1000.0))
+
+            # Positions where Stockfish failed during the search are dropped; we take new candidates for those.
+            for (evaluation, fen_white) in zip(evaluations, fens):
+                if evaluation is not None:
+                    results.append(evaluation + (fen_white, ))
+
+        return results
+    finally:
+        engines.put(stockfish)
 
 
 def main():
@@ -265,6 +626,12 @@ def main():
         parser.add_argument("--no-highlight", dest="highlight", action='store_false', help="do not highlight lines with small absolute centipawn value")
         parser.add_argument("--highlight-threshold", type=int, default=20, help="highlight threshold (centipawns)")
         parser.add_argument("--movetime", type=float, help="move time for position evaluation (s)", default=1.0)
+        parser.add_argument("--min-depth", type=int, help="stop the evaluation early once this search depth is reached (default: search for the full move time)")
+        parser.add_argument("--timeout", type=float, default=60.0, help="restart a Stockfish process that is silent for longer than the move time plus this margin (s) (default: 60)")
+        parser.add_argument("--verify-readback", type=int, default=100, metavar="N", help="check the FEN read back from Stockfish for the first N positions of each worker; -1 to always check (default: 100)")
+        parser.add_argument("-b", "--batch-size", type=int, default=1, help="number of positions that a worker collects before evaluating them back to back (default: 1)")
+        parser.add_argument("--pin-cores", action='store_true', help="pin each Stockfish process to its own physical CPU core; at most one worker per core is allowed")
+        parser.add_argument("-w", "--workers", type=int, help="number of Stockfish processes to run in parallel (default: number of CPUs available; with --pin-cores, number of physical cores available)")
 
         args = parser.parse_args()
 
@@ -284,45 +651,77 @@ def main():
             colorama.init()
             exit_stack.callback(colorama.deinit)
 
-        board = Board()
+        # Fail early if the material doesn't fit on the board, rather than in the generator thread.
+        try:
+            Board().place_random_pieces(args.material)
+        except IllegalPositionError:
+            pass
+        except ValueError:
+            parser.error("material does not fit on the board: {}".format(args.material))
+
+        candidates = queue.Queue(maxsize=8)
+        threading.Thread(target=generate_candidates, args=(candidates, args.material), daemon=True).start()
+
+        # Each worker drives its own single-threaded Stockfish process.
+        # If requested, the processes are pinned to distinct physical cores; by default, we then use all of those.
+        # Otherwise, by default we run one per CPU that we may run on.
+        if args.pin_cores:
+            if not hasattr(os, "sched_setaffinity"):
+                parser.error("pinning to cores is not supported on this platform")
+            cpus = physical_cpus()
+            if args.workers is None:
+                args.workers = len(cpus)
+            elif args.workers > len(cpus):
+                parser.error("cannot pin {} workers to {} physical cores".format(args.workers, len(cpus)))
+        elif args.workers is None:
+            if hasattr(os, "sched_getaffinity"):
+                args.workers = len(os.sched_getaffinity(0))
+            else:
+                args.workers = os.cpu_count() or 1
 
-        stockfish = exit_stack.enter_context(Stockfish(executable))
+        engines = queue.Queue()
+        for i in range(args.workers):
+            verify_readback = args.verify_readback if args.verify_readback >= 0 else None
+            cpu = cpus[i] if args.pin_cores else None
+            engines.put(exit_stack.enter_context(Stockfish(executable, {"Threads": "1"}, verify_readback, args.movetime + args.timeout, cpu)))
 
-        num_found = 0
-        while num_found < 1000:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=args.workers)
+        exit_stack.callback(executor.shutdown, cancel_futures=True)
 
-            board.mk_empty()
-            board.place_random_pieces(args.material)
+        num_wanted = 1000
+        batch_sizes = [min(args.batch_size, num_wanted - i) for i in range(0, num_wanted, args.batch_size)]
 
-            fen_black = board.fen('b')
-            status = stockfish.set_fen(fen_black)
-            if status in (StockfishStatus.MoverInCheck, StockfishStatus.Fault):
-                continue
+        futures = [executor.submit(find_positions, engines, candidates, batch_size, args.movetime, args.min_depth) for batch_size in batch_sizes]
 
-            fen_white = board.fen('w')
-            status = stockfish.set_fen(fen_white)
-            if status in (StockfishStatus.MoverInCheck, StockfishStatus.Fault):
-                continue
+        if args.highlight:
+            (highlight_on, highlight_off) = (colorama.Style.BRIGHT + colorama.Fore.YELLOW, colorama.Style.RESET_ALL)
+
+        # Output lines are collected, and written once at least 'flush_lines' lines are pending.
+        out_buf = []
+        flush_lines = 16
+        exit_stack.callback(lambda: sys.stdout.write("".join(out_buf)))
 
-            t1 = time.monotonic()
-            evaluation = stockfish.evaluate(movetime = round(args.movetime * 1000.0))
-            t2 = time.monotonic()
+        num_found = 0
+        for future in concurrent.futures.as_completed(futures):
 
-            duration = t2 - t1
+            for (evaluation, duration, fen_white) in future.result():
 
-            if args.highlight:
-                highlight_line = evaluation.startswith("cp") and abs(int(evaluation.split()[1])) < args.highlight_threshold            
-            else:
-                highlight_line = False
+                if args.highlight:
+                    highlight_line = evaluation.startswith("cp") and abs(int(evaluation.split()[1])) < args.highlight_threshold            
+                else:
+                    highlight_line = False
+
+                num_found += 1
+                line = "{:6d} evaluation {:20} duration {:10.3f} fen {} \n".format(num_found, evaluation, duration, fen_white)
 
-            if highlight_line:
-                print(colorama.Style.BRIGHT + colorama.Fore.YELLOW, end='')
+                if highlight_line:
+                    line = highlight_on + line + highlight_off
 
-            num_found += 1
-            print("{:6d} evaluation {:20} duration {:10.3f} fen {} ".format(num_found, evaluation, duration, fen_white))
+                out_buf.append(line)
 
-            if highlight_line:
-                print(colorama.Style.RESET_ALL, end='')
+            if len(out_buf) >= flush_lines:
+                sys.stdout.write("".join(out_buf))
+                out_buf.clear()
 
 if __name__ == "__main__":
     main()